@@ -2,4 +2,6 @@
 
 from .main_action import run
 
-run()
+# worker processes import this module too, they must not start gpncfg again
+if __name__ == "__main__":
+    run()
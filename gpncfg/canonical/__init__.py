@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(data, indent=False):
+    """
+    Serialize data to json with sorted keys, so equal data always results in
+    the same text. The text is compact, or indented by two spaces if indent
+    is set. orjson is used when it is installed. Its output is only taken if
+    it contains no characters the json module would escape, then it matches
+    the output of the json module apart from floats in exponent notation and
+    nan.
+    """
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            text = orjson.dumps(data, option=option).decode()
+        except TypeError:
+            # for example integer keys, which the json module converts
+            text = None
+        if text is not None and text.isascii() and "\x7f" not in text:
+            return text
+
+    if indent:
+        return json.dumps(data, indent=2, sort_keys=True)
+    return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+
+def strip_indent(text):
+    """
+    Remove the line breaks and indentation from json text indented by
+    dumps(). json strings do not contain line breaks, so the data stays the
+    same.
+    """
+    return re.sub(r"\n *", "", text)
+
+
+def get_digest(text):
+    if isinstance(text, str):
+        text = text.encode()
+    return hashlib.sha256(text).hexdigest()
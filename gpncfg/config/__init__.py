@@ -88,11 +88,22 @@ class ConfigProvider:
             config_file_parser_class=configargparse.TomlConfigParser(["gpncfg"]),
         )
 
+        parser.add_argument(
+            "--cache-backend",
+            choices=["files", "sqlite"],
+            default="files",
+            help="how to store nautobot data in the cache directory. sqlite allows loading only the devices selected by --limit",
+        )
         parser.add_argument(
             "--cache-dir",
             default=get_cache_path(),
             help="directory in which to cache nautobot data",
         )
+        parser.add_argument(
+            "--cache-keep",
+            default=100,
+            help="how many snapshots of nautobot data to keep in the cache directory. 0 keeps all of them",
+        )
         parser.add_argument(
             "-c",
             "--config",
@@ -132,15 +143,46 @@ class ConfigProvider:
             default="gpncfg",
             help="what user to authenticate as when deploying configs",
         )
+        parser.add_argument(
+            "--device",
+            default=False,
+            help="only fetch, generate and write the config of the device with this nautobot id or name, and print it",
+        )
+        parser.add_argument(
+            "--full-sync-interval",
+            default=60 * 30,
+            help="when syncing incrementally, still fetch all data from nautobot after this many seconds",
+        )
+        parser.add_argument(
+            "--graphql-concurrency",
+            default=4,
+            help="how many graphql queries to run against nautobot at the same time",
+        )
+        parser.add_argument(
+            "--graphql-shard-size",
+            default=25,
+            help="how many devices to fetch per graphql query",
+        )
         parser.add_argument(
             "--graphql-timeout",
             default="240",
             help="how log to wait for the graphql query to complete before timing out",
         )
+        parser.add_argument(
+            "--incremental-sync",
+            action="store_true",
+            default=False,
+            help="in daemon mode, only refetch devices and vlans that changed according to nautobot's changelog",
+        )
+        parser.add_argument(
+            "--jobs",
+            default=1,
+            help="how many processes to fiddle and render configs in",
+        )
         parser.add_argument(
             "--limit",
             default=[],
-            help="comma separated list of nautobot device ids. deploy workers are started only for those devices.",
+            help="comma separated list of nautobot device ids. configs are generated and deploy workers are started only for those devices. when using the cache, only those devices are loaded.",
         )
         parser.add_argument(
             "--login-file",
@@ -196,6 +238,16 @@ class ConfigProvider:
             help="where to output the configs",
             required=True,
         )
+        parser.add_argument(
+            "--poll-interval-max",
+            default=60 * 5,
+            help="in daemon mode, wait up to this many seconds between fetches from nautobot while its data does not change",
+        )
+        parser.add_argument(
+            "--poll-interval-min",
+            default=10,
+            help="in daemon mode, wait this many seconds between fetches from nautobot after its data changed",
+        )
         parser.add_argument(
             "--populate-cache",
             action="store_true",
@@ -227,6 +279,12 @@ class ConfigProvider:
             help="the snmp contact address of the devices",
             required=True,
         )
+        parser.add_argument(
+            "--stream-configs",
+            action="store_true",
+            default=False,
+            help="render configs straight into their files in the output directory instead of keeping them in memory",
+        )
         parser.add_argument(
             "--syslog-server",
             help="the syslog server for the devices",
@@ -242,6 +300,21 @@ class ConfigProvider:
             help="do not fetch new data from nautobot and instead use this file as cache. implies --use-cache",
             default=False,
         )
+        parser.add_argument(
+            "--webhook-debounce",
+            default=5,
+            help="after receiving a webhook, wait until nautobot sent no further webhooks for this many seconds before fetching",
+        )
+        parser.add_argument(
+            "--webhook-port",
+            default=False,
+            help="in daemon mode, listen for nautobot webhooks on this port. each webhook triggers a fetch from nautobot. requires --webhook-secret",
+        )
+        parser.add_argument(
+            "--webhook-secret",
+            default=False,
+            help="secret nautobot signs its webhooks with. as a secret, it must not be provided on the cli",
+        )
 
         options = parser.parse_args()
 
@@ -252,6 +325,7 @@ class ConfigProvider:
         refuse_secret_on_cli(args, "--nautobot-token")
         refuse_secret_on_cli(args, "--nvue-pass")
         refuse_secret_on_cli(args, "--snmp-community")
+        refuse_secret_on_cli(args, "--webhook-secret")
 
         self.options = options
 
@@ -310,8 +384,28 @@ class ConfigProvider:
             log.fatal("cannot populate cache in offline mode")
             exit(1)
 
+        if self.options.device and (self.options.daemon or self.options.populate_cache):
+            log.fatal("--device cannot be combined with --daemon or --populate-cache")
+            exit(1)
+
+        if self.options.webhook_port and not self.options.webhook_secret:
+            # the port is open on all interfaces, unsigned webhooks would
+            # let anyone trigger fetches
+            log.fatal("--webhook-port requires a --webhook-secret")
+            exit(1)
+
         if isinstance(self.options.limit, str):
             self.options.limit = self.options.limit.split(",")
 
+        self.options.cache_keep = int(self.options.cache_keep)
+        self.options.graphql_concurrency = int(self.options.graphql_concurrency)
+        self.options.graphql_shard_size = int(self.options.graphql_shard_size)
         self.options.graphql_timeout = int(self.options.graphql_timeout)
+        self.options.full_sync_interval = int(self.options.full_sync_interval)
+        self.options.jobs = int(self.options.jobs)
         self.options.config_age = int(self.options.config_age)
+        self.options.poll_interval_max = int(self.options.poll_interval_max)
+        self.options.poll_interval_min = int(self.options.poll_interval_min)
+        self.options.webhook_debounce = int(self.options.webhook_debounce)
+        if self.options.webhook_port:
+            self.options.webhook_port = int(self.options.webhook_port)
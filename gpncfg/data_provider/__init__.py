@@ -1,181 +1,539 @@
 #!/usr/bin/env python3
 
+import asyncio
 import datetime
-import glob
-import hashlib
 import json
 import logging
 import os
 import time
+import uuid
 
 import gql
+import graphql
 from gql.transport.aiohttp import AIOHTTPTransport
 
+from .cache import CacheStore, Snapshot, SqliteCacheStore
+from .intern import Interner
+
 log = logging.getLogger(__name__)
 
 
+# file in the cache directory to store nautobot's graphql schema in
+SCHEMA_CACHE = "graphql-schema.json"
+
+# how many changelog entries to inspect during an incremental sync. if more
+# changes happened since the last sync, fall back to a full sync.
+CHANGELOG_LIMIT = 250
+
+DEVICE_FILTER = """
+    status: ["Active","Staged","Planned"]
+    manufacturer: ["Juniper", "Mellanox"]
+    tags__n: "gpncfg-ignore"
+    role: ["access switch" "core switch" "Router"]
+"""
+
+VLAN_FILTER = """
+    status:"Active"
+"""
+
+DEVICE_FIELDS = """
+    name,
+    tags { name },
+    status { name },
+    id,
+    serial,
+    location{name},
+    device_type{
+        manufacturer{
+            name,
+        },
+        model,
+    },
+    role {
+        name,
+    },
+    primary_ip4 {
+      address
+      host
+      parent {
+        rel_gateway {
+          host
+        }
+      }
+    }
+    primary_ip6 {
+      address
+      host
+      parent {
+        rel_gateway {
+          host
+        }
+      }
+    }
+    interfaces {
+        name,
+        mgmt_only,
+        tags {
+            name
+        }
+        ip_addresses {
+          address
+          host
+          ip_version
+          parent {
+            rel_gateway {
+              host
+              ip_version
+            }
+          }
+        },
+        description,
+        id,
+        type,
+        mode,
+        member_interfaces { name },
+        tagged_vlans{name,vid},
+        untagged_vlan{name,vid},
+        _custom_field_data,
+        vrf { name },
+    }
+    bgp_routing_instances {
+      autonomous_system {
+        asn
+      }
+      endpoints {
+        peer {
+          autonomous_system {
+            asn
+            description
+          }
+          source_ip {
+            ip_version
+            host
+          }
+        }
+      }
+      peer_groups {
+        name
+        endpoints {
+          peer {
+            autonomous_system {
+              asn
+              description
+            }
+            source_ip {
+              host
+            }
+          }
+          source_ip {
+            host
+          }
+        }
+      }
+    }
+    rel_reject_routes {
+        ip_version
+        prefix
+    }
+    _custom_field_data
+"""
+
+VLAN_FIELDS = """
+    name,
+    vid,
+    id
+"""
+
+
 class DataProvider:
     def __init__(self, cfg):
         self.data = None
         self.cfg = cfg
         self.last_hash = None
+        self.last_full_sync = None
+        if cfg.cache_backend == "sqlite":
+            self.store = SqliteCacheStore(cfg.cache_dir, cfg.cache_keep)
+        else:
+            self.store = CacheStore(cfg.cache_dir, cfg.cache_keep)
+        # hash of the current data, identifies a generation of configs
+        self.generation = None
+        # the graphql connection is established on first use and kept open
+        self.loop = None
+        self.client = None
+        self.session = None
+        self.queries = self.parse_queries()
 
-    def fetch_nautobot_graphql(self):
-        log.info(f"fetching device information from api at {self.cfg.nautobot_url}")
+    def parse_queries(self):
+        filters = self.get_filters()
+        args = dict(filters, fields=DEVICE_FIELDS, vlan_fields=VLAN_FIELDS)
+        # everything needed to generate the config of a single device
+        single = """
+            query ($selector: [String]) {
+                object_changes(limit:1) {
+                    request_id
+                    time
+                }
+                devices(%(key)s: $selector %(devices)s) {%(fields)s}
+                vlans(%(vlans)s) {%(vlan_fields)s}
+            }
+        """
+        return {
+            "changelog": gql.gql(
+                """
+                query ($limit: Int) {
+                    object_changes(limit: $limit) {
+                        request_id
+                        time
+                        action
+                        changed_object_type { app_label, model }
+                        changed_object_id
+                        related_object_id
+                        object_data
+                    }
+                }
+                """
+            ),
+            "device-id": gql.gql(single % dict(args, key="id")),
+            "device-name": gql.gql(single % dict(args, key="name")),
+            "devices": gql.gql(
+                """
+                query ($ids: [String]) {
+                    devices(id: $ids %(devices)s) {%(fields)s}
+                }
+                """
+                % args
+            ),
+            "index": gql.gql(
+                """
+                query {
+                    object_changes(limit:1) {
+                        request_id
+                        time
+                    }
+                    devices(%(devices)s) { id }
+                    vlans(%(vlans)s) {%(vlan_fields)s}
+                }
+                """
+                % args
+            ),
+            "vlans": gql.gql(
+                """
+                query {
+                    vlans(%(vlans)s) {%(vlan_fields)s}
+                }
+                """
+                % args
+            ),
+        }
+
+    def connect(self):
+        if self.session is not None:
+            return
+
+        log.debug(f"connecting to graphql api at {self.cfg.nautobot_url}")
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.connect_async())
+        except Exception as e:
+            log.error("failed to connect to the graphql api", exc_info=e)
+            self.disconnect()
+            raise e
+
+    async def connect_async(self):
         transport = AIOHTTPTransport(
             url=self.cfg.nautobot_url + "/api/graphql/",
             headers={"Authorization": "Token %s" % self.cfg.nautobot_token},
         )
 
-        # Create a GraphQL client using the defined transport
-        client = gql.Client(
+        # Create a GraphQL client using the defined transport. it does not
+        # know the schema, so queries are not validated again on every
+        # execution.
+        self.client = gql.Client(
             transport=transport,
-            fetch_schema_from_transport=True,
             execute_timeout=self.cfg.graphql_timeout,
         )
+        # the aiohttp session behind the client keeps its connections alive
+        # between fetches
+        self.session = await self.client.connect_async()
 
-        tenant = ""
-        if self.cfg.nautobot_tenant:
-            tenant = 'tenant:"{}"'.format(self.cfg.nautobot_tenant)
+        async with transport.session.get(
+            self.cfg.nautobot_url + "/api/status/"
+        ) as response:
+            response.raise_for_status()
+            version = (await response.json())["nautobot-version"]
+        log.debug(f"nautobot is running version {version}")
 
-        # Provide a GraphQL query
-        query = gql.gql(
-            """
-            query {
-                object_changes(limit:1) {
-                    request_id
-                }
-                devices(
-                    status: ["Active","Staged","Planned"]
-                    manufacturer: ["Juniper", "Mellanox"]
-                    tags__n: "gpncfg-ignore"
-                    role: ["access switch" "core switch" "Router"]
-                    %(tenant)s
-                ) {
-                    name,
-                    tags { name },
-                    status { name },
-                    id,
-                    serial,
-                    location{name},
-                    device_type{
-                        manufacturer{
-                            name,
-                        },
-                        model,
-                    },
-                    role {
-                        name,
-                    },
-                    primary_ip4 {
-                      address
-                      host
-                      parent {
-                        rel_gateway {
-                          host
-                        }
-                      }
-                    }
-                    primary_ip6 {
-                      address
-                      host
-                      parent {
-                        rel_gateway {
-                          host
-                        }
-                      }
-                    }
-                    interfaces {
-                        name,
-                        mgmt_only,
-                        tags {
-                            name
-                        }
-                        ip_addresses {
-                          address
-                          host
-                          ip_version
-                          parent {
-                            rel_gateway {
-                              host
-                              ip_version
-                            }
-                          }
-                        },
-                        description,
-                        id,
-                        type,
-                        mode,
-                        member_interfaces { name },
-                        tagged_vlans{name,vid},
-                        untagged_vlan{name,vid},
-                        _custom_field_data,
-                        vrf { name },
-                    }
-                    bgp_routing_instances {
-                      autonomous_system {
-                        asn
-                      }
-                      endpoints {
-                        peer {
-                          autonomous_system {
-                            asn
-                            description
-                          }
-                          source_ip {
-                            ip_version
-                            host
-                          }
-                        }
-                      }
-                      peer_groups {
-                        name
-                        endpoints {
-                          peer {
-                            autonomous_system {
-                              asn
-                              description
-                            }
-                            source_ip {
-                              host
-                            }
-                          }
-                          source_ip {
-                            host
-                          }
-                        }
-                      }
-                   }
-                   rel_reject_routes {
-                       ip_version
-                       prefix
-                   }
-                   _custom_field_data
-                },
-                vlans(
-                    status:"Active"
-                    %(tenant)s
-                ) {
-                    name,
-                    vid
-                }
-            }
-            """
-            % {"tenant": tenant}
+        schema = await self.load_schema(version)
+        for name, query in self.queries.items():
+            if errors := graphql.validate(schema, query):
+                raise Exception(
+                    f"graphql query '{name}' does not match the nautobot schema: {errors}"
+                )
+
+    async def load_schema(self, version):
+        path = os.path.join(self.cfg.cache_dir, SCHEMA_CACHE)
+        try:
+            with open(path, "r") as file:
+                cached = json.load(file)
+            if cached["nautobot-version"] == version:
+                log.debug(f"using cached graphql schema at '{path}'")
+                return graphql.build_client_schema(cached["introspection"])
+            log.info(
+                "nautobot version changed from {} to {}, refreshing graphql schema".format(
+                    cached["nautobot-version"], version
+                )
+            )
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            log.info("no cached graphql schema found, fetching it from nautobot")
+
+        introspection = await self.session.execute(
+            gql.gql(graphql.get_introspection_query())
         )
+        self.assert_cache_writeable()
+        with open(path, "w") as file:
+            json.dump(
+                {"nautobot-version": version, "introspection": introspection}, file
+            )
+            file.write("\n")
 
-        # Execute the query on the transport
+        return graphql.build_client_schema(introspection)
+
+    def disconnect(self):
+        if self.loop is None:
+            return
+
+        if self.session is not None:
+            try:
+                self.loop.run_until_complete(self.client.close_async())
+            except Exception as e:
+                log.debug("failed to cleanly close graphql session", exc_info=e)
+        self.loop.close()
+        self.loop = None
+        self.session = None
+        self.client = None
+
+    def execute_graphql(self, *requests):
+        """
+        Execute the given (query name, variables) requests concurrently over
+        the persistent connection and return their results in the same order.
+        """
+        if not requests:
+            return []
+
+        self.connect()
+        try:
+            return self.loop.run_until_complete(self.execute_graphql_async(requests))
+        except Exception:
+            # start over with a fresh connection and a revalidated schema on
+            # the next fetch, nautobot might have been upgraded
+            self.disconnect()
+            raise
+
+    async def execute_graphql_async(self, requests):
+        # bound the number of queries nautobot has to answer at the same time
+        semaphore = asyncio.Semaphore(self.cfg.graphql_concurrency)
+
+        async def execute(name, variables):
+            async with semaphore:
+                return await self.session.execute(
+                    self.queries[name], variable_values=variables
+                )
+
+        # Execute the queries on the transport
         pre = time.time()
         try:
-            result = client.execute(query)
+            return await asyncio.gather(*(execute(*r) for r in requests))
         except Exception as e:
             log.error("graphql query failed", exc_info=e)
             raise e
         finally:
             post = time.time()
-            log.debug("graphql query finished in {} seconds".format(post - pre))
+            log.debug(
+                "{} graphql queries finished in {} seconds".format(
+                    len(requests), post - pre
+                )
+            )
+
+    def get_device_shards(self, ids):
+        """
+        Split fetching the given devices into shards of --graphql-shard-size
+        devices each, so nautobot can work on them concurrently.
+        """
+        size = self.cfg.graphql_shard_size
+        return [
+            ("devices", {"ids": ids[i : i + size]}) for i in range(0, len(ids), size)
+        ]
+
+    def get_filters(self):
+        tenant = ""
+        if self.cfg.nautobot_tenant:
+            tenant = 'tenant:"{}"'.format(self.cfg.nautobot_tenant)
+
+        return {
+            "devices": DEVICE_FILTER + tenant,
+            "vlans": VLAN_FILTER + tenant,
+        }
+
+    def fetch_nautobot_graphql(self):
+        if self.cfg.incremental_sync and self.data is not None:
+            age = time.time() - self.last_full_sync
+            if age > self.cfg.full_sync_interval:
+                log.info(
+                    f"last full sync was {int(age)} seconds ago, doing a full sync"
+                )
+            elif self.fetch_nautobot_graphql_incremental():
+                return
+
+        log.info(f"fetching device information from api at {self.cfg.nautobot_url}")
+        # first only fetch the device ids, then the devices in shards
+        (index,) = self.execute_graphql(("index", {}))
+
+        ids = [device["id"] for device in index["devices"]]
+        results = self.execute_graphql(*self.get_device_shards(ids))
+        log.debug(f"fetched {len(ids)} devices in {len(results)} shards")
+
+        fetched = dict()
+        interner = Interner()
+        for result in results:
+            for device in result["devices"]:
+                fetched[device["id"]] = interner.device(device)
+
+        # keep the order of the index, devices deleted in the meantime are
+        # skipped
+        index["devices"] = [fetched[id] for id in ids if id in fetched]
+        self.data = index
+        self.last_full_sync = time.time()
+
+    def fetch_nautobot_graphql_incremental(self):
+        """
+        Patch the previously fetched data with the objects that changed since
+        then according to nautobot's changelog. Returns False if the changes
+        cannot be applied incrementally and a full sync is needed instead.
+        """
+        try:
+            last = self.data["object_changes"][0]
+        except (KeyError, IndexError):
+            log.debug(
+                "previous data has no changelog position, cannot sync incrementally"
+            )
+            return False
+
+        log.info(
+            f"fetching changes since request {last['request_id']} from api at {self.cfg.nautobot_url}"
+        )
+        (result,) = self.execute_graphql(("changelog", {"limit": CHANGELOG_LIMIT}))
+
+        # the changelog is ordered newest first, collect all changes up to the
+        # last request we have already seen
+        changes = []
+        for change in result["object_changes"]:
+            if change["request_id"] == last["request_id"]:
+                break
+            changes.append(change)
+        else:
+            log.info(
+                f"last seen request is not among the {CHANGELOG_LIMIT} most recent changes, doing a full sync"
+            )
+            return False
+
+        if not changes:
+            log.debug("changelog contains no new changes, data is up to date")
+            return True
+
+        device_ids = set()
+        vids = set()
+        for change in changes:
+            kind = "{app_label}.{model}".format(**change["changed_object_type"])
+            if kind == "dcim.device":
+                device_ids.add(change["changed_object_id"])
+            elif kind == "dcim.interface" and change["related_object_id"]:
+                # nautobot records the parent device as the interface's related object
+                device_ids.add(change["related_object_id"])
+            elif kind == "ipam.vlan":
+                # vlans are embedded in interfaces by name and vid, so every
+                # device referencing the old or new vid needs to be refetched
+                for vlan in self.data["vlans"]:
+                    if vlan.get("id") == change["changed_object_id"]:
+                        vids.add(vlan["vid"])
+                if vid := (change["object_data"] or {}).get("vid"):
+                    vids.add(vid)
+            else:
+                log.info(f"changelog contains change to {kind}, doing a full sync")
+                return False
+
+        for device in self.data["devices"]:
+            for iface in device["interfaces"]:
+                used = [vlan["vid"] for vlan in iface["tagged_vlans"]]
+                if iface["untagged_vlan"]:
+                    used.append(iface["untagged_vlan"]["vid"])
+                if vids.intersection(used):
+                    device_ids.add(device["id"])
+                    break
+
+        log.info(
+            f"patching {len(changes)} changes affecting {len(device_ids)} devices and {len(vids)} vlans"
+        )
+
+        requests = self.get_device_shards(sorted(device_ids))
+        if vids:
+            requests.append(("vlans", {}))
+        result = dict(devices=[])
+        for shard in self.execute_graphql(*requests):
+            result["devices"].extend(shard.get("devices", []))
+            if "vlans" in shard:
+                result["vlans"] = shard["vlans"]
 
-        self.data = result
+        # replace changed devices in place, drop the ones that were deleted or
+        # no longer match the filters and append new ones
+        interner = Interner()
+        fetched = {
+            device["id"]: interner.device(device)
+            for device in result.get("devices", [])
+        }
+        patched = []
+        for device in self.data["devices"]:
+            if device["id"] not in device_ids:
+                patched.append(device)
+            elif device["id"] in fetched:
+                patched.append(fetched.pop(device["id"]))
+        patched.extend(fetched.values())
+
+        data = dict(self.data)
+        data["devices"] = patched
+        if "vlans" in result:
+            data["vlans"] = result["vlans"]
+        data["object_changes"] = [
+            {"request_id": changes[0]["request_id"], "time": changes[0]["time"]}
+        ]
+        self.data = data
+        return True
+
+    def fetch_device(self, selector):
+        """
+        Fetch only the device with the given nautobot id or name, together
+        with the vlans. Nothing is written to the cache.
+        """
+        if self.cfg.use_cache:
+            self.fetch_cache()
+            data = dict(self.data)
+            data["devices"] = [
+                device
+                for device in self.data["devices"]
+                if selector in (device["id"], device["name"])
+            ]
+        else:
+            try:
+                uuid.UUID(selector)
+                key = "id"
+            except ValueError:
+                key = "name"
+            log.info(f"fetching device {selector} from api at {self.cfg.nautobot_url}")
+            (data,) = self.execute_graphql((f"device-{key}", {"selector": [selector]}))
+
+        if not data["devices"]:
+            log.fatal(f"no device with id or name '{selector}' found, exiting")
+            exit(1)
+        self.data = data
 
     def fetch_nautobot(self):
         # make sure the cache directory is good before doing possibly expensive
@@ -183,7 +541,11 @@ class DataProvider:
         self.assert_cache_writeable()
         self.hash_last()
         # contact graphql api
+        previous = self.data
         self.fetch_nautobot_graphql()
+        if self.data is previous:
+            log.debug("data was not modified by the fetch, not saving cache")
+            return
         # save cache
         self.save_cache()
 
@@ -191,8 +553,10 @@ class DataProvider:
         log.debug("saving device information to cache")
         self.assert_cache_writeable()
 
-        cur_hash = self.hash_data()
+        snapshot = Snapshot(self.data)
+        cur_hash = snapshot.digest
         log.debug("data returned from nautobot hashes to {}".format(cur_hash))
+        self.generation = cur_hash
 
         # if no hash was provided fetch it now
         self.hash_last()
@@ -201,26 +565,28 @@ class DataProvider:
         if cur_hash == self.last_hash:
             log.debug("cache is up to date")
         else:
-            name = "nautobot-{}.json".format(
+            # keep the microseconds so two saves within one second get
+            # different names. a comma separates them, a dot would be taken
+            # for the start of the suffix
+            name = "nautobot-{}{}".format(
                 datetime.datetime.now(datetime.timezone.utc)
-                .replace(microsecond=0, tzinfo=datetime.timezone.utc)
-                .isoformat()
+                .isoformat(timespec="microseconds")
+                .replace(".", ","),
+                self.store.suffix,
             )
             log.info(
                 "most recent cache is outdated, saving new cache to {}".format(name)
             )
-            self.save_cache_to(name)
-
-    def save_cache_to(self, name):
-        path = os.path.join(self.cfg.cache_dir, name)
-        with open(path, "w") as file:
-            json.dump(self.data, file, indent=4, sort_keys=True)
-            file.write("\n")
+            self.store.save(name, snapshot)
+            self.last_hash = cur_hash
 
     def fetch_cache(self):
         self.assert_cache_readable()
+        store = self.store
         if self.cfg.use_cache_file:
             cache_file = self.cfg.use_cache_file
+            # explicitly named cache files are always read from disk
+            store = CacheStore(os.path.dirname(cache_file), 0)
         else:
             cache_file = self.get_latest_cache_path()
         log.info(f"fetching device information from cache at '{cache_file}'")
@@ -231,24 +597,24 @@ class DataProvider:
             )
             exit(1)
 
-        with open(cache_file, "r") as file:
-            self.data = json.load(file)
+        # in daemon mode the cache is read on every loop, skip loading it if
+        # it did not change
+        cur_hash = store.digest(cache_file)
+        if cur_hash == self.generation:
+            log.debug("cache file is unchanged, not loading it again")
+            return
+        # only load the devices that configs are generated for, and only
+        # while configs are generated for them
+        self.data = store.stream(cache_file, self.cfg.limit or None)
+        self.generation = cur_hash
 
     def get_latest_cache_path(self):
-        pattern = os.path.join(self.cfg.cache_dir, "nautobot-*.json")
-        files = glob.glob(pattern)
-        if files == []:
+        file = self.store.latest()
+        if file is None:
             log.debug("no previous cache files found")
-            return None
         else:
-            files.sort()
-            file = files[-1]
             log.debug("found previous cache file {}".format(file))
-            return file
-
-    def hash_data(self):
-        text = json.dumps(self.data, indent=4, sort_keys=True) + "\n"
-        return hashlib.sha256(text.encode()).hexdigest()
+        return file
 
     def hash_last(self):
         if self.last_hash is not None:
@@ -262,12 +628,7 @@ class DataProvider:
             self.last_hash = False
             return
 
-        size = os.path.getsize(last_path)
-        with open(last_path, "r") as f:
-            # specify size to prevent waiting indefinitely on empty files
-            text = f.read(size)
-
-        self.last_hash = hashlib.sha256(text.encode()).hexdigest()
+        self.last_hash = self.store.digest(last_path)
 
     def assert_cache_readable(self):
         log.debug(f"making sure cache directory at '{self.cfg.cache_dir}' is readable")
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+
+import fcntl
+import glob
+import gzip
+import json
+import logging
+import os
+import sqlite3
+
+from .. import canonical
+from .intern import Interner
+
+log = logging.getLogger(__name__)
+
+# directory inside the cache directory holding the device records
+OBJECTS_DIR = "objects"
+
+# file inside the cache directory listing all snapshots
+INDEX_FILE = "index.json"
+
+# file inside the cache directory locked while a snapshot is saved
+LOCK_FILE = "cache.lock"
+
+# database inside the cache directory used by the sqlite backend
+SQLITE_FILE = "nautobot.sqlite3"
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    digest TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    devices INTEGER NOT NULL,
+    shared BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshot_devices (
+    snapshot TEXT NOT NULL REFERENCES snapshots (name) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    device_id TEXT NOT NULL,
+    digest TEXT NOT NULL REFERENCES objects (digest),
+    PRIMARY KEY (snapshot, position)
+);
+CREATE INDEX IF NOT EXISTS snapshot_devices_by_id ON snapshot_devices (snapshot, device_id);
+CREATE INDEX IF NOT EXISTS snapshot_devices_by_digest ON snapshot_devices (digest);
+"""
+
+
+def serialize(data):
+    return canonical.dumps(data).encode()
+
+
+def get_timestamp(name):
+    return name.removeprefix("nautobot-").split(".")[0]
+
+
+class Snapshot:
+    """
+    A dataset split into a manifest and the device records it references by
+    their hash. Identical device records are only stored once, no matter how
+    many snapshots reference them. Each device of the dataset gets its hash
+    as fingerprint.
+    """
+
+    def __init__(self, data):
+        self.objects = dict()
+        self.ids = [device["id"] for device in data["devices"]]
+        self.manifest = dict(data)
+        self.manifest["devices"] = list()
+        for device in data["devices"]:
+            # the fingerprint of an earlier snapshot is not part of the data
+            device.pop("fingerprint", None)
+            text = serialize(device)
+            digest = canonical.get_digest(text)
+            device["fingerprint"] = digest
+            self.objects[digest] = text
+            self.manifest["devices"].append(digest)
+
+        self.text = serialize(self.manifest)
+        self.digest = canonical.get_digest(self.text)
+        self.size = len(self.text) + sum(len(text) for text in self.objects.values())
+
+
+class Devices:
+    """
+    The devices of a cached snapshot. They are read from the cache store one
+    at a time whenever they are iterated, so only the device currently being
+    worked on has to be parsed and kept in memory.
+    """
+
+    def __init__(self, store, name, ids=None):
+        self.store = store
+        self.name = name
+        self.ids = ids
+
+    def __iter__(self):
+        interner = Interner()
+        return map(interner.device, self.store.iter_devices(self.name, self.ids))
+
+
+class CacheStore:
+    suffix = ".json.gz"
+
+    def __init__(self, path, keep):
+        self.path = path
+        self.keep = keep
+        self.index = None
+        self.index_mtime = None
+
+    def object_path(self, digest, base=None):
+        base = base or self.path
+        return os.path.join(base, OBJECTS_DIR, digest + ".json.gz")
+
+    def snapshots(self):
+        """
+        Return the paths of all snapshot files, oldest first. Plain json files
+        are left over from older versions of gpncfg and are still understood.
+        """
+        files = glob.glob(os.path.join(self.path, "nautobot-*.json"))
+        files.extend(glob.glob(os.path.join(self.path, "nautobot-*.json.gz")))
+        # the names only differ in their timestamp
+        files.sort(key=lambda file: os.path.basename(file).split(".")[0])
+        return files
+
+    def read_index(self):
+        """
+        Return the index entries of all snapshots, oldest first. The index is
+        read again when another gpncfg process changed it and rebuilt from
+        the snapshot files if it is missing.
+        """
+        path = os.path.join(self.path, INDEX_FILE)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime != self.index_mtime:
+                with open(path, "r") as file:
+                    self.index = json.load(file)
+                self.index_mtime = mtime
+        except (FileNotFoundError, json.JSONDecodeError):
+            log.info(f"cache index at '{path}' is missing or broken, rebuilding it")
+            self.index = list()
+            for file in self.snapshots():
+                data = self.load(file)
+                snapshot = Snapshot(data)
+                self.index.append(
+                    self.index_entry(
+                        os.path.basename(file), self.digest(file), snapshot
+                    )
+                )
+            try:
+                self.write_index()
+            except OSError as e:
+                log.warning("failed to save rebuilt cache index", exc_info=e)
+        return self.index
+
+    def index_entry(self, name, digest, snapshot):
+        return {
+            "name": name,
+            "timestamp": get_timestamp(name),
+            "digest": digest,
+            "size": snapshot.size,
+            "devices": len(snapshot.manifest["devices"]),
+        }
+
+    def write_index(self):
+        path = os.path.join(self.path, INDEX_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(self.index, file, indent=1)
+            file.write("\n")
+        os.replace(tmp, path)
+        self.index_mtime = os.stat(path).st_mtime_ns
+
+    def latest(self):
+        index = self.read_index()
+        if index == []:
+            return None
+        return os.path.join(self.path, index[-1]["name"])
+
+    def read_manifest(self, path):
+        """
+        Return the manifest of the snapshot at path together with its hash. For
+        old plain json files the manifest is the whole dataset.
+        """
+        with open(path, "rb") as file:
+            text = file.read()
+        if path.endswith(".gz"):
+            text = gzip.decompress(text)
+        return json.loads(text), canonical.get_digest(text)
+
+    def digest(self, path):
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.path):
+            name = os.path.basename(path)
+            for entry in reversed(self.index or []):
+                if entry["name"] == name:
+                    return entry["digest"]
+        return self.read_manifest(path)[1]
+
+    def load(self, path, ids=None):
+        """
+        Load the snapshot at path. If ids is given, only keep those devices.
+        This backend has to read all of them anyway.
+        """
+        data = self.stream(path, ids)
+        data["devices"] = list(data["devices"])
+        return data
+
+    def stream(self, path, ids=None):
+        """
+        Like load, but the devices are only read one at a time while they are
+        iterated.
+        """
+        manifest, _ = self.read_manifest(path)
+        data = dict(manifest)
+        if path.endswith(".gz"):
+            data["devices"] = Devices(self, path, ids)
+        else:
+            # old plain json files have already been parsed as a whole
+            interner = Interner()
+            data["devices"] = [
+                interner.device(device)
+                for device in data["devices"]
+                if ids is None or device["id"] in ids
+            ]
+        return data
+
+    def iter_devices(self, path, ids=None):
+        manifest, _ = self.read_manifest(path)
+        base = os.path.dirname(path)
+        for digest in manifest["devices"]:
+            with gzip.open(self.object_path(digest, base), "rb") as file:
+                device = json.load(file)
+            if ids is None or device["id"] in ids:
+                device["fingerprint"] = digest
+                yield device
+
+    def save(self, name, snapshot):
+        """
+        Write the snapshot and the device records it introduces. The texts
+        written are the ones its hashes were computed from, so nothing is
+        serialized or hashed twice.
+        """
+        os.makedirs(os.path.join(self.path, OBJECTS_DIR), exist_ok=True)
+        # another gpncfg process, like a --populate-cache cron job next to the
+        # daemon, may save a snapshot at the same time. hold the lock from
+        # reading the index until it is written again
+        with open(os.path.join(self.path, LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # the mtime may not have changed if the other process was quick
+            self.index_mtime = None
+            index = self.read_index()
+
+            written = 0
+            for digest, text in snapshot.objects.items():
+                path = self.object_path(digest)
+                if os.path.exists(path):
+                    continue
+                self.write(path, text)
+                written += 1
+            log.debug(
+                f"stored {written} new of {len(snapshot.objects)} device records in cache"
+            )
+
+            self.write(os.path.join(self.path, name), snapshot.text)
+            # a snapshot saved under the same name was just overwritten, its
+            # entry must not stay behind or compact() removes the new file
+            index[:] = [entry for entry in index if entry["name"] != name]
+            index.append(self.index_entry(name, snapshot.digest, snapshot))
+            self.compact()
+            self.write_index()
+
+    def write(self, path, text):
+        # write to a temporary file first so no half written files are left
+        # behind when gpncfg gets interrupted
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as file:
+            file.write(gzip.compress(text, mtime=0))
+        os.replace(tmp, path)
+
+    def compact(self):
+        """
+        Remove all but the newest --cache-keep snapshots and the device records
+        no longer referenced by any snapshot.
+        """
+        if not self.keep or len(self.index) <= self.keep:
+            return
+
+        for entry in self.index[: -self.keep]:
+            log.debug("removing old cache snapshot {name}".format(**entry))
+            try:
+                os.remove(os.path.join(self.path, entry["name"]))
+            except FileNotFoundError:
+                pass
+        del self.index[: -self.keep]
+
+        # collect the references of all snapshots on disk, not only the ones
+        # in the index, so no records of a snapshot are removed before it
+        # is indexed
+        referenced = set()
+        for path in self.snapshots():
+            if path.endswith(".gz"):
+                referenced.update(self.read_manifest(path)[0]["devices"])
+
+        removed = 0
+        for file in glob.glob(self.object_path("*")):
+            digest = os.path.basename(file).split(".")[0]
+            if digest not in referenced:
+                os.remove(file)
+                removed += 1
+        log.debug(f"removed {removed} unreferenced device records from cache")
+
+
+class SqliteCacheStore:
+    """
+    Stores snapshots in a sqlite database in the cache directory. Every
+    device of a snapshot is a row keyed by its nautobot id, the vlans and
+    other shared data are kept with the snapshot. Identical device records
+    are stored once, and single devices can be loaded without reading the
+    whole snapshot.
+    """
+
+    suffix = ""
+
+    def __init__(self, path, keep):
+        self.path = path
+        self.keep = keep
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(os.path.join(self.path, SQLITE_FILE))
+            self.db.execute("PRAGMA foreign_keys = ON")
+            self.db.executescript(SQLITE_SCHEMA)
+        return self.db
+
+    def latest(self):
+        row = (
+            self.connect()
+            .execute("SELECT name FROM snapshots ORDER BY name DESC LIMIT 1")
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def digest(self, name):
+        row = (
+            self.connect()
+            .execute("SELECT digest FROM snapshots WHERE name = ?", (name,))
+            .fetchone()
+        )
+        if row is None:
+            raise FileNotFoundError(f"no snapshot named '{name}' in sqlite cache")
+        return row[0]
+
+    def load(self, name, ids=None):
+        """
+        Load the snapshot called name. If ids is given, only those devices are
+        read from the database.
+        """
+        data = self.stream(name, ids)
+        data["devices"] = list(data["devices"])
+        return data
+
+    def stream(self, name, ids=None):
+        """
+        Like load, but the devices are only read one at a time while they are
+        iterated.
+        """
+        row = (
+            self.connect()
+            .execute("SELECT shared FROM snapshots WHERE name = ?", (name,))
+            .fetchone()
+        )
+        if row is None:
+            raise FileNotFoundError(f"no snapshot named '{name}' in sqlite cache")
+        data = json.loads(row[0])
+        data["devices"] = Devices(self, name, ids)
+        return data
+
+    def iter_devices(self, name, ids=None):
+        query = """
+            SELECT objects.data, objects.digest FROM snapshot_devices
+            JOIN objects ON objects.digest = snapshot_devices.digest
+            WHERE snapshot_devices.snapshot = ?
+        """
+        args = [name]
+        if ids is not None:
+            query += " AND snapshot_devices.device_id IN ({})".format(
+                ",".join("?" * len(ids))
+            )
+            args.extend(ids)
+        query += " ORDER BY snapshot_devices.position"
+
+        for data, digest in self.connect().execute(query, args):
+            device = json.loads(data)
+            device["fingerprint"] = digest
+            yield device
+
+    def save(self, name, snapshot):
+        db = self.connect()
+        shared = dict(snapshot.manifest)
+        del shared["devices"]
+
+        with db:
+            db.executemany(
+                "INSERT OR IGNORE INTO objects (digest, data) VALUES (?, ?)",
+                snapshot.objects.items(),
+            )
+            # replace a snapshot saved under the same name, its devices are
+            # removed along with it
+            db.execute("DELETE FROM snapshots WHERE name = ?", (name,))
+            db.execute(
+                "INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    name,
+                    get_timestamp(name),
+                    snapshot.digest,
+                    snapshot.size,
+                    len(snapshot.ids),
+                    serialize(shared),
+                ),
+            )
+            db.executemany(
+                "INSERT INTO snapshot_devices VALUES (?, ?, ?, ?)",
+                (
+                    (name, position, id, digest)
+                    for position, (id, digest) in enumerate(
+                        zip(snapshot.ids, snapshot.manifest["devices"])
+                    )
+                ),
+            )
+            self.compact()
+
+    def compact(self):
+        """
+        Remove all but the newest --cache-keep snapshots and the device records
+        no longer referenced by any snapshot.
+        """
+        if not self.keep:
+            return
+
+        db = self.connect()
+        removed = db.execute(
+            """
+            DELETE FROM snapshots WHERE name NOT IN (
+                SELECT name FROM snapshots ORDER BY name DESC LIMIT ?
+            )
+            """,
+            (self.keep,),
+        ).rowcount
+        if removed:
+            log.debug(f"removed {removed} old snapshots from sqlite cache")
+            db.execute(
+                """
+                DELETE FROM objects WHERE digest NOT IN (
+                    SELECT digest FROM snapshot_devices
+                )
+                """
+            )
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+
+class Interner:
+    """
+    Replaces equal records embedded all over the devices, like vlans, tags
+    and statuses, by a single shared instance. Every access switch carries
+    the same vlans on dozens of interfaces, after interning each of them only
+    exists once in memory. Interned records must not be modified in place,
+    copy them instead.
+    """
+
+    def __init__(self):
+        self.pool = dict()
+
+    def record(self, record):
+        if record is None:
+            return None
+        # nested records have already been interned and are compared by
+        # identity. they are kept alive by the pool, so their ids are unique
+        key = tuple(
+            (k, type(v), id(v) if isinstance(v, dict) else v) for k, v in record.items()
+        )
+        try:
+            return self.pool.setdefault(key, record)
+        except TypeError:
+            # records containing lists are kept as they are
+            return record
+
+    def records(self, records):
+        return [self.record(record) for record in records]
+
+    def device(self, device):
+        """
+        Intern the records of a freshly fetched or loaded device in place and
+        return it.
+        """
+        device["tags"] = self.records(device["tags"])
+        device["status"] = self.record(device["status"])
+        device["role"] = self.record(device["role"])
+        device["location"] = self.record(device["location"])
+        device_type = device["device_type"]
+        device_type["manufacturer"] = self.record(device_type["manufacturer"])
+        device["device_type"] = self.record(device_type)
+        device["_custom_field_data"] = self.record(device["_custom_field_data"])
+
+        for iface in device["interfaces"]:
+            iface["tags"] = self.records(iface["tags"])
+            iface["tagged_vlans"] = self.records(iface["tagged_vlans"])
+            iface["untagged_vlan"] = self.record(iface["untagged_vlan"])
+            iface["vrf"] = self.record(iface["vrf"])
+            iface["_custom_field_data"] = self.record(iface["_custom_field_data"])
+            for addr in iface["ip_addresses"]:
+                if parent := addr["parent"]:
+                    parent["rel_gateway"] = self.record(parent["rel_gateway"])
+                    addr["parent"] = self.record(parent)
+
+        return device
@@ -11,6 +11,7 @@ import requests
 from netmiko import ReadTimeout
 from requests_toolbelt.adapters.host_header_ssl import HostHeaderSSLAdapter
 
+from .. import canonical
 from ..statistics import Statistics, StatisticsType
 from ..threadaction import Action, ShutdownCommencing
 
@@ -188,7 +189,7 @@ class DeployDriver(Action):
                     self.log.debug(f"skipped {i} outdated configs")
                     break
 
-            if not cwc.config:
+            if not cwc.has_config():
                 self.log.warning("config was not rendered, waiting for new config")
                 continue
 
@@ -275,7 +276,7 @@ class DeployJunos(DeployDriver):
         os.makedirs("/var/tmp/gpncfg", mode=0o751, exist_ok=True)
         tmp = os.path.abspath(os.path.join("/var/tmp/gpncfg", "config-" + serial))
         with open(tmp, "w+") as file:
-            print(cwc.config, file=file)
+            print(cwc.read(), file=file)
 
         sts = Statistics()
         sts.update(device["nodename"], StatisticsType.CONTACT)
@@ -549,7 +550,9 @@ class DeployCumulus(DeployDriver):
 
             session.delete(f"{base}/", params=params)
             self.honor_exit()
-            session.patch(f"{base}/", data=json.dumps(device["config"]), params=params)
+            session.patch(
+                f"{base}/", data=canonical.strip_indent(cwc.payload), params=params
+            )
             sts.update(device["nodename"], StatisticsType.UPDATE)
 
             diff = self.get_diff(base, session, rev, device["nodename"])
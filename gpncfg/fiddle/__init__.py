@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 
-import copy
 import datetime
+import functools
 import ipaddress
 import json
 import logging
 import re
 
+from .. import canonical
 from .cumulus import CUMULUS_CONFIG, UNNUMBERED_BGP
 
 log = logging.getLogger(__name__)
@@ -15,6 +16,8 @@ log = logging.getLogger(__name__)
 TRANS_SLUG = str.maketrans({"ß": "ss", "ö": "oe", "ä": "ae", "ü": "ue"})
 
 
+# the same vlan, device and interface names are slugified over and over
+@functools.lru_cache(maxsize=16384)
 def slugify(text):
     """
     Juniper requires VLAN names to be at least two characters long, starting with a letter.
@@ -39,341 +42,552 @@ def sanitize_vlans(data):
     return data
 
 
+def shallow_copy(data):
+    """
+    Copy the parts of the data that get modified while fiddling. This way the
+    data provider can hold on to the data as it was fetched from nautobot.
+    Devices are copied one at a time while fiddling.
+    """
+    data = dict(data)
+    data["vlans"] = [dict(vlan) for vlan in data["vlans"]]
+    return data
+
+
+def get_timestamp():
+    return (
+        datetime.datetime.now(datetime.timezone.utc)
+        .replace(microsecond=0, tzinfo=datetime.timezone.utc)
+        .isoformat()
+    )
+
+
+def get_tags(obj):
+    return frozenset(tag["name"] for tag in obj["tags"])
+
+
+def copy_paths(base, *paths):
+    """
+    Return a copy of base in which the dicts along the given paths are copied
+    too, so they can be modified. Everything else is shared with base and
+    must not be modified.
+    """
+    tree = dict(base)
+    for path in paths:
+        node, orig = tree, base
+        for key in path:
+            orig = orig[key]
+            if node[key] is orig:
+                node[key] = dict(orig)
+            node = node[key]
+    return tree
+
+
+def format_vlan_ranges(vids):
+    """
+    Format vids as a sorted list of ranges like nvue uses them, for example
+    "10-50,100,200-210".
+    """
+    ranges = list()
+    for vid in sorted(set(vids)):
+        if ranges and ranges[-1][1] == vid - 1:
+            ranges[-1][1] = vid
+        else:
+            ranges.append([vid, vid])
+    return ",".join(
+        str(first) if first == last else f"{first}-{last}" for first, last in ranges
+    )
+
+
+def get_port_key(iface):
+    """
+    Return the settings of a Juniper port that end up in its interface
+    stanza. Ports with equal keys get the same stanza.
+    """
+    mode = iface["mode"]
+    if mode not in ("ACCESS", "TAGGED", "TAGGED_ALL"):
+        return (mode,)
+    vlan = iface["untagged_vlan"]
+    if vlan:
+        vlan = (vlan["vid"], vlan["name"])
+    if mode == "TAGGED":
+        return (mode, vlan, iface["tagged_vlans_text"])
+    return (mode, vlan)
+
+
+def split_port_name(name):
+    """
+    Split the name of a Juniper ethernet port like ge-0/0/12 into its prefix
+    and number. Returns None for other interfaces.
+    """
+    match = re.fullmatch(r"((?:fe|ge|mge|xe|et)-\d+/\d+/)(\d+)", name)
+    if not match:
+        return None
+    return match[1], int(match[2])
+
+
+def get_interface_ranges(ifaces):
+    """
+    Group ports with the same settings into interface ranges, so their
+    settings are only written once. Each range holds the port its settings
+    are taken from and its members as pairs of the first and last port of
+    consecutive ports. Only ethernet ports of the same kind and pic share a
+    range, lags and ports that do not share their settings with another port
+    are not put in one. The ports in a range get its name.
+    """
+    groups = dict()
+    for iface in ifaces:
+        iface["range"] = None
+        if iface["mgmt_only"] or iface["type"] == "LAG":
+            continue
+        if port := split_port_name(iface["name"]):
+            key = (port[0], get_port_key(iface))
+            groups.setdefault(key, []).append(iface)
+
+    ranges = list()
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        name = "ports-{}".format(len(ranges))
+        runs = list()
+        last = None
+        for iface in sorted(members, key=lambda i: split_port_name(i["name"])):
+            iface["range"] = name
+            prefix, number = split_port_name(iface["name"])
+            if last == (prefix, number - 1):
+                runs[-1][1] = iface["name"]
+            else:
+                runs.append([iface["name"], iface["name"]])
+            last = (prefix, number)
+        ranges.append({"name": name, "iface": members[0], "members": runs})
+    return ranges
+
+
+def get_fingerprint(device):
+    return canonical.get_digest(canonical.dumps(device))
+
+
+def get_device_fingerprint(device):
+    """
+    Return the fingerprint of the nautobot data of the device. Devices that
+    were saved to or loaded from the cache carry the hash they are stored
+    under, which is the same, so they do not have to be serialized again.
+    """
+    if (fingerprint := device.get("fingerprint")) is not None:
+        return fingerprint
+    return get_fingerprint(device)
+
+
 class Fiddler:
     def __init__(self, cfg):
         self.cfg = cfg
+        # devices fiddled during the previous run by the fingerprint of their
+        # nautobot data. the config options they depend on do not change
+        # while gpncfg runs, only the motd has to be replaced.
+        self.memo = dict()
+        # the same for every core switch. shared by all of their configs, so
+        # they must not be modified
+        self.cumulus_users = self.get_cumulus_users()
+        self.snmp_communities = {self.cfg.snmp_community: {"access": {"any": {}}}}
+
+    def get_cumulus_users(self):
+        ousers = dict()
+
+        for user in self.cfg.login.user:
+            okeys = dict()
+            for i, key in enumerate(user["ed25519"] + user["ecdsa"] + user["rsa"]):
+                parts = key.split(" ")
+                okeys[user["name"] + str(i)] = {
+                    "type": parts[0],
+                    "key": parts[1],
+                }
+            ousercfg = {
+                "role": "system-admin",
+                "ssh": {"authorized-key": okeys},
+            }
+            if user["password"]:
+                ousercfg["hashed-password"] = user["password"]
+            else:
+                ousercfg["hashed-password"] = self.cfg.login.root.sha512
+            ousers[user["name"]] = ousercfg
+
+        ousers["cumulus"] = {
+            "role": "system-admin",
+            "hashed-password": self.cfg.login.root.sha512,
+        }
+        return ousers
 
-    def fiddle(self, data):
+    def get_motd(self, data, ts):
+        request_id = data["object_changes"][0]["request_id"]
+        return self.cfg.motd.format(timestamp=ts, request_id=request_id)
+
+    def fiddle(self, data, ts=None):
         log.info("fiddling data")
-        ts = (
-            datetime.datetime.now(datetime.timezone.utc)
-            .replace(microsecond=0, tzinfo=datetime.timezone.utc)
-            .isoformat()
-        )
+        ts = ts or get_timestamp()
+        data = shallow_copy(data)
         data = sanitize_vlans(data)
-        data = self.fiddle_devices(data, ts)
+        data["motd"] = self.get_motd(data, ts)
+        data["devices"] = self.fiddle_devices(data["devices"], data["motd"])
         return data
 
-    def fiddle_devices(self, data, ts):
-        for device in data["devices"]:
-            # set usecase and device id
-            if device["serial"] == "":
-                device["serial"] = "fallback-serial-" + device["id"]
-
-            device["usecase"] = "_".join(
-                slugify(x)
-                for x in [
-                    device["role"]["name"],
-                    device["device_type"]["manufacturer"]["name"],
-                    device["device_type"]["model"],
-                ]
+    def fiddle_devices(self, devices, motd):
+        """
+        Fiddle the devices one after another while they are being iterated,
+        so each one can be rendered before the next one is even loaded.
+        """
+        memo = dict()
+        for device in devices:
+            fingerprint = get_device_fingerprint(device)
+            if fiddled := memo.get(fingerprint) or self.memo.get(fingerprint):
+                device = self.replace_motd(fiddled, motd)
+            else:
+                device = self.fiddle_device(dict(device), motd)
+                # apart from the motd, the fiddled device only depends on
+                # the nautobot data it was fiddled from
+                device["fingerprint"] = fingerprint
+            memo[fingerprint] = device
+            yield device
+
+        log.debug(
+            "fiddled {} devices, reused {} of them".format(
+                len(memo), len(memo.keys() & self.memo.keys())
             )
-            usecase = device["usecase"]
+        )
+        self.memo = memo
+
+    def replace_motd(self, device, motd):
+        """
+        Return a copy of the fiddled device with another motd. Only the parts
+        leading to the motd are copied, everything else is shared with the
+        original.
+        """
+        device = dict(device)
+        device["motd"] = motd
+        if (
+            device["role"]["name"] == "access switch"
+            and device["device_type"]["manufacturer"]["name"] == "Juniper"
+        ):
+            device["motd"] = json.dumps(motd)
+        elif device["usecase"] in [
+            "core-switch_mellanox_sn2410",
+            "core-switch_mellanox_sn3420",
+        ]:
+            device["config"] = dict(device["config"])
+            device["config"]["system"] = dict(device["config"]["system"])
+            device["config"]["system"]["message"] = {"pre-login": motd}
+        return device
+
+    def fiddle_device(self, device, motd):
+        # set usecase and device id
+        if device["serial"] == "":
+            device["serial"] = "fallback-serial-" + device["id"]
+
+        device["usecase"] = "_".join(
+            slugify(x)
+            for x in [
+                device["role"]["name"],
+                device["device_type"]["manufacturer"]["name"],
+                device["device_type"]["model"],
+            ]
+        )
+        usecase = device["usecase"]
 
-            # log what we are doing
-            log.debug("fiddling config for serial {}'".format(device["serial"]))
+        # log what we are doing
+        log.debug("fiddling config for serial {}'".format(device["serial"]))
 
-            # add general stuff
-            if (name := device["name"]) is not None:
-                device["nodename"] = slugify(name)
-            else:
-                device["nodename"] = "device-" + device["id"]
-
-            request_id = data["object_changes"][0]["request_id"]
-            device["motd"] = self.cfg.motd.format(timestamp=ts, request_id=request_id)
-
-            device["deploy"] = device["status"]["name"] in {"Active", "Staged"}
-            for tag in device["tags"]:
-                if tag["name"] == "gpncfg-no-deploy":
-                    device["deploy"] = False
-
-            try:
-                device["gateway"] = device["primary_ip4"]["parent"]["rel_gateway"][
-                    "host"
-                ]
-            except TypeError:
-                if device["role"]["name"] == "access":
-                    log.warning(
-                        "access device has no gateway {nodename} {serial})".format(
-                            **device
-                        )
-                    )
-                device["gateway"] = None
+        # add general stuff
+        if (name := device["name"]) is not None:
+            device["nodename"] = slugify(name)
+        else:
+            device["nodename"] = "device-" + device["id"]
+
+        device["motd"] = motd
 
-            device["addresses"] = {6: [], 4: []}
-            if addr := device.get("primary_ip6"):
-                device["addresses"][6].append(addr["host"])
-            if addr := device.get("primary_ip4"):
-                device["addresses"][4].append(addr["host"])
+        device["deploy"] = device["status"]["name"] in {"Active", "Staged"}
+        if "gpncfg-no-deploy" in get_tags(device):
+            device["deploy"] = False
 
-            log.debug(
-                "found management addreses {addresses} for device {name} ({serial})".format(
-                    **device
+        try:
+            device["gateway"] = device["primary_ip4"]["parent"]["rel_gateway"]["host"]
+        except TypeError:
+            if device["role"]["name"] == "access":
+                log.warning(
+                    "access device has no gateway {nodename} {serial})".format(**device)
                 )
-            )
+            device["gateway"] = None
 
-            # add data based on usecase
-            if (
-                device["role"]["name"] == "access switch"
-                and device["device_type"]["manufacturer"]["name"] == "Juniper"
-            ):
-                # use json to escape special characters
-                device["motd"] = json.dumps(device["motd"])
-
-                # sort interfaces into physical and virtual ones as they are
-                # treated very differently.
-                device["physical_interfaces"] = list()
-                device["virtual_interfaces"] = list()
-                device["vids"] = list()
-
-                for iface in device["interfaces"]:
-                    iface = copy.deepcopy(iface)
-
-                    if iface["type"] == "VIRTUAL":
-                        if iface["untagged_vlan"] is None:
-                            log.warning(
-                                "virtual interface '{}' with no untagged vid on device '{}' serial '{}'".format(
-                                    iface["name"],
-                                    device["name"],
-                                    device["serial"],
-                                )
-                            )
-                            continue
-                        device["vids"].append(iface["untagged_vlan"]["vid"])
-                        # set ip addresses assigned in nautobot, if there are
-                        # none then do dhcp
-                        if len(iface["ip_addresses"]) > 0:
-                            iface["do_dhcp"] = False
-                        else:
-                            iface["do_dhcp"] = True
-                        device["virtual_interfaces"].append(iface)
+        device["addresses"] = {6: [], 4: []}
+        if addr := device.get("primary_ip6"):
+            device["addresses"][6].append(addr["host"])
+        if addr := device.get("primary_ip4"):
+            device["addresses"][4].append(addr["host"])
 
-                    else:
-                        # format the list of tagged vlans to a string
-                        tagged = ["["]
-                        tagged.extend(
-                            slugify(vlan["name"]) for vlan in iface["tagged_vlans"]
-                        )
+        log.debug(
+            "found management addreses {addresses} for device {name} ({serial})".format(
+                **device
+            )
+        )
 
-                        if (
-                            device["device_type"]["model"].startswith("EX2300C")
-                            and iface["untagged_vlan"]
-                        ):
-                            tagged.append(slugify(iface["untagged_vlan"]["name"]))
-
-                        tagged.append("]")
-                        iface["tagged_vlans_text"] = " ".join(tagged)
-
-                        if (
-                            iface["mode"] == "TAGGED"
-                            and iface["tagged_vlans_text"] == "[ ]"
-                        ):
-                            iface["mode"] = None
-
-                        # slugify the untagged vlan name
-                        if iface["untagged_vlan"] is not None:
-                            iface["untagged_vlan"]["name"] = slugify(
-                                iface["untagged_vlan"]["name"]
+        # add data based on usecase
+        if (
+            device["role"]["name"] == "access switch"
+            and device["device_type"]["manufacturer"]["name"] == "Juniper"
+        ):
+            # use json to escape special characters
+            device["motd"] = json.dumps(device["motd"])
+
+            # sort interfaces into physical and virtual ones as they are
+            # treated very differently.
+            device["physical_interfaces"] = list()
+            device["virtual_interfaces"] = list()
+            device["vids"] = list()
+            # vids of the vlans the device references
+            used_vids = set()
+            tagged_all = False
+
+            for iface in device["interfaces"]:
+                iface = dict(iface)
+
+                if iface["type"] == "VIRTUAL":
+                    if iface["untagged_vlan"] is None:
+                        log.warning(
+                            "virtual interface '{}' with no untagged vid on device '{}' serial '{}'".format(
+                                iface["name"],
+                                device["name"],
+                                device["serial"],
                             )
-
-                        device["physical_interfaces"].append(iface)
-
-            elif usecase in [
-                "core-switch_mellanox_sn2410",
-                "core-switch_mellanox_sn3420",
-            ]:
-                config = copy.deepcopy(CUMULUS_CONFIG)
-
-                config["system"]["hostname"] = device["nodename"]
-                config["system"]["message"] = {"pre-login": device["motd"]}
-                osnmp = {self.cfg.snmp_community: {"access": {"any": {}}}}
-                config["system"]["snmp-server"]["readonly-community"] = osnmp
-                config["system"]["snmp-server"]["readonly-community-v6"] = osnmp
-
-                if device["nodename"] == "cumulus-test":
-                    config["system"]["ssh-server"]["strict"] = "disabled"
-
-                ifaces = dict()
-                oneigh = dict()
-                vlans = set()
-                dhcp_relay_count = 0
-                for iif in device["interfaces"]:
-                    oif = {}
-                    vlancfg = dict()
-                    vlans.update(vlan["vid"] for vlan in iif["tagged_vlans"])
-                    if vlan := iif["untagged_vlan"]:
-                        vlans.add(vlan["vid"])
-                        vlancfg["untagged"] = vlan["vid"]
-                    if iif["tagged_vlans"]:
-                        vlanstr = ",".join(
-                            str(vlan["vid"]) for vlan in iif["tagged_vlans"]
                         )
-                        vlancfg["vlan"] = {vlanstr: dict()}
-
-                    if vlancfg and iif["type"] != "VIRTUAL":
-                        oif["bridge"] = {"domain": {"br_default": vlancfg}}
-
-                    if iaddrs := iif["ip_addresses"]:
-                        oif["ip"] = {"address": {}}
-
-                        if iif["vrf"]:
-                            oif["ip"]["vrf"] = iif["vrf"]["name"]
-                        elif iif["name"].startswith("eth"):
-                            oif["ip"]["vrf"] = "mgmt"
-
-                        if iif["_custom_field_data"].get("dhcp_client", False):
-                            oif["ip"]["address"] = {"dhcp": {}}
-                        else:
-                            oaddrs = dict()
-                            ogateways = {4: [], 6: []}
-                            for addr in iaddrs:
-                                oaddrs[addr["address"]] = dict()
-                                try:
-                                    g = addr["parent"]["rel_gateway"]
-                                    ogateways[g["ip_version"]].append(g["host"])
-                                except TypeError:
-                                    pass
-
-                            if iif["_custom_field_data"].get("set_gateway", False):
-                                for ver in ogateways.values():
-                                    if ver:
-                                        oif["ip"]["gateway"] = {ver[0]: {}}
-
-                            oif["ip"]["address"] = oaddrs
-                    elif iif["vrf"]:
-                        oif["ip"] = {"vrf": iif["vrf"]["name"]}
-                    elif iif["name"].startswith("eth"):
-                        oif["ip"] = {"vrf": "mgmt"}
-
-                    if iif["type"] == "LAG":
-                        oif["type"] = "bond"
-                        obond = dict()
-                        for iface in iif["member_interfaces"]:
-                            obond[iface["name"]] = dict()
-                        oif["bond"] = {"member": obond, "mode": "lacp"}
-                    elif iif["type"] == "VIRTUAL":
-                        oif["type"] = "svi"
-                        if vlan := iif["untagged_vlan"]:
-                            oif["vlan"] = vlan["vid"]
-
-                    if iif["name"] == "lo":
-                        for addr in iif["ip_addresses"]:
-                            if addr["ip_version"] == 4:
-                                config["router"]["bgp"]["router-id"] = addr["host"]
-                        oif["type"] = "loopback"
-
-                    for tag in iif["tags"]:
-                        if tag["name"] == "unnumbered bgp":
-                            oneigh[iif["name"]] = UNNUMBERED_BGP
-                        elif tag["name"] == "send router advertisements":
-                            oif["ip"]["neighbor-discovery"] = {
-                                "router-advertisement": {"enable": "on"},
-                                "rdnss": {
-                                    "2a0e:c5c1:0:10::7": {},
-                                    "2a0e:c5c1:0:10::8": {},
-                                },
-                            }
-                        elif tag["name"] == "dhcp relay":
-                            dhcp_relay_count += 1
-                            config["service"]["dhcp-relay"]["default"]["interface"][
-                                iif["name"]
-                            ] = {}
-
-                    ifaces[slugify(iif["name"])] = oif
-
-                config["interface"] = ifaces
-                if vlans:
-                    vlanstr = ",".join(str(vlan) for vlan in vlans)
-                    config["bridge"]["domain"]["br_default"]["vlan"][vlanstr] = {}
+                        continue
+                    device["vids"].append(iface["untagged_vlan"]["vid"])
+                    used_vids.add(iface["untagged_vlan"]["vid"])
+                    # set ip addresses assigned in nautobot, if there are
+                    # none then do dhcp
+                    if len(iface["ip_addresses"]) > 0:
+                        iface["do_dhcp"] = False
+                    else:
+                        iface["do_dhcp"] = True
+                    device["virtual_interfaces"].append(iface)
+
                 else:
-                    del config["bridge"]["domain"]["br_default"]["vlan"]
+                    if iface["mode"] == "TAGGED_ALL":
+                        tagged_all = True
+                    used_vids.update(vlan["vid"] for vlan in iface["tagged_vlans"])
+                    if iface["untagged_vlan"]:
+                        used_vids.add(iface["untagged_vlan"]["vid"])
+
+                    # format the list of tagged vlans to a string
+                    tagged = ["["]
+                    tagged.extend(
+                        slugify(vlan["name"]) for vlan in iface["tagged_vlans"]
+                    )
 
-                stp_priority = device["_custom_field_data"].get(
-                    "spanning_tree_priority"
-                )
-                if not stp_priority:
-                    stp_priority = 4
-                # no, .get alone is not enough, since nautobot can also contain a Null value here
+                    if (
+                        device["device_type"]["model"].startswith("EX2300C")
+                        and iface["untagged_vlan"]
+                    ):
+                        tagged.append(slugify(iface["untagged_vlan"]["name"]))
 
-                config["bridge"]["domain"]["br_default"]["stp"]["priority"] = (
-                    stp_priority * 4096
-                )
+                    tagged.append("]")
+                    iface["tagged_vlans_text"] = " ".join(tagged)
 
-                if dhcp_relay_count == 0:
-                    config["service"].pop("dhcp-relay")
+                    if (
+                        iface["mode"] == "TAGGED"
+                        and iface["tagged_vlans_text"] == "[ ]"
+                    ):
+                        iface["mode"] = None
 
-                ousers = dict()
+                    # slugify the untagged vlan name
+                    if vlan := iface["untagged_vlan"]:
+                        iface["untagged_vlan"] = dict(vlan, name=slugify(vlan["name"]))
 
-                for user in self.cfg.login.user:
-                    okeys = dict()
-                    for i, key in enumerate(
-                        user["ed25519"] + user["ecdsa"] + user["rsa"]
-                    ):
-                        parts = key.split(" ")
-                        okeys[user["name"] + str(i)] = {
-                            "type": parts[0],
-                            "key": parts[1],
-                        }
-                    ousercfg = {
-                        "role": "system-admin",
-                        "ssh": {"authorized-key": okeys},
-                    }
-                    if user["password"]:
-                        ousercfg["hashed-password"] = user["password"]
-                    else:
-                        ousercfg["hashed-password"] = self.cfg.login.root.sha512
-                    ousers[user["name"]] = ousercfg
+                    device["physical_interfaces"].append(iface)
 
-                ousers["cumulus"] = {
-                    "role": "system-admin",
-                    "hashed-password": self.cfg.login.root.sha512,
-                }
+            device["interface_ranges"] = get_interface_ranges(
+                device["physical_interfaces"]
+            )
 
-                for routing in device["bgp_routing_instances"]:
-                    config["router"]["bgp"]["autonomous-system"] = routing[
-                        "autonomous_system"
-                    ]["asn"]
-                    for endpoint in routing["endpoints"]:
-                        peer = endpoint["peer"]
-                        oneigh[peer["source_ip"]["host"]] = {
-                            "address-family": {
-                                "ipv{}-unicast".format(
-                                    peer["source_ip"]["ip_version"]
-                                ): {"enable": "on"}
-                            },
-                            "remote-as": peer["autonomous_system"]["asn"],
-                            "type": "numbered",
-                        }
-                config["vrf"]["default"]["router"]["bgp"]["neighbor"] = oneigh
-                if not oneigh:
-                    log.warning(
-                        "routing instance has no neighbors {nodename} {serial}".format(
-                            **device
-                        )
+            # ports carrying all vlans need all of them to be defined
+            device["used_vids"] = None if tagged_all else used_vids
+
+        elif usecase in [
+            "core-switch_mellanox_sn2410",
+            "core-switch_mellanox_sn3420",
+        ]:
+            # only the parts of the template modified below are copied, the
+            # rest is shared by the configs of all core switches
+            config = copy_paths(
+                CUMULUS_CONFIG,
+                ("bridge", "domain", "br_default", "stp"),
+                ("bridge", "domain", "br_default", "vlan"),
+                ("router", "bgp"),
+                ("service", "dhcp-relay", "default", "interface"),
+                ("system", "aaa"),
+                ("system", "snmp-server"),
+                ("system", "ssh-server"),
+                ("vrf", "default", "router", "bgp"),
+            )
+
+            config["system"]["hostname"] = device["nodename"]
+            config["system"]["message"] = {"pre-login": device["motd"]}
+            osnmp = self.snmp_communities
+            config["system"]["snmp-server"]["readonly-community"] = osnmp
+            config["system"]["snmp-server"]["readonly-community-v6"] = osnmp
+
+            if device["nodename"] == "cumulus-test":
+                config["system"]["ssh-server"]["strict"] = "disabled"
+
+            ifaces = dict()
+            oneigh = dict()
+            vlans = set()
+            dhcp_relay_count = 0
+            for iif in device["interfaces"]:
+                oif = {}
+                vlancfg = dict()
+                vlans.update(vlan["vid"] for vlan in iif["tagged_vlans"])
+                if vlan := iif["untagged_vlan"]:
+                    vlans.add(vlan["vid"])
+                    vlancfg["untagged"] = vlan["vid"]
+                if iif["tagged_vlans"]:
+                    vlanstr = format_vlan_ranges(
+                        vlan["vid"] for vlan in iif["tagged_vlans"]
                     )
+                    vlancfg["vlan"] = {vlanstr: dict()}
+
+                if vlancfg and iif["type"] != "VIRTUAL":
+                    oif["bridge"] = {"domain": {"br_default": vlancfg}}
+
+                if iaddrs := iif["ip_addresses"]:
+                    oif["ip"] = {"address": {}}
 
-                ostatic = dict()
+                    if iif["vrf"]:
+                        oif["ip"]["vrf"] = iif["vrf"]["name"]
+                    elif iif["name"].startswith("eth"):
+                        oif["ip"]["vrf"] = "mgmt"
 
-                for prefix in device["rel_reject_routes"]:
-                    ostatic[prefix["prefix"]] = {
-                        "via": {"reject": {"type": "reject"}},
-                        "address-family": f"ipv{prefix['ip_version']}-unicast",
+                    if iif["_custom_field_data"].get("dhcp_client", False):
+                        oif["ip"]["address"] = {"dhcp": {}}
+                    else:
+                        oaddrs = dict()
+                        ogateways = {4: [], 6: []}
+                        for addr in iaddrs:
+                            oaddrs[addr["address"]] = dict()
+                            try:
+                                g = addr["parent"]["rel_gateway"]
+                                ogateways[g["ip_version"]].append(g["host"])
+                            except TypeError:
+                                pass
+
+                        if iif["_custom_field_data"].get("set_gateway", False):
+                            for ver in ogateways.values():
+                                if ver:
+                                    oif["ip"]["gateway"] = {ver[0]: {}}
+
+                        oif["ip"]["address"] = oaddrs
+                elif iif["vrf"]:
+                    oif["ip"] = {"vrf": iif["vrf"]["name"]}
+                elif iif["name"].startswith("eth"):
+                    oif["ip"] = {"vrf": "mgmt"}
+
+                if iif["type"] == "LAG":
+                    oif["type"] = "bond"
+                    obond = dict()
+                    for iface in iif["member_interfaces"]:
+                        obond[iface["name"]] = dict()
+                    oif["bond"] = {"member": obond, "mode": "lacp"}
+                elif iif["type"] == "VIRTUAL":
+                    oif["type"] = "svi"
+                    if vlan := iif["untagged_vlan"]:
+                        oif["vlan"] = vlan["vid"]
+
+                if iif["name"] == "lo":
+                    for addr in iif["ip_addresses"]:
+                        if addr["ip_version"] == 4:
+                            config["router"]["bgp"]["router-id"] = addr["host"]
+                    oif["type"] = "loopback"
+
+                tags = get_tags(iif)
+                if "unnumbered bgp" in tags:
+                    oneigh[iif["name"]] = UNNUMBERED_BGP
+                if "send router advertisements" in tags:
+                    oif["ip"]["neighbor-discovery"] = {
+                        "router-advertisement": {"enable": "on"},
+                        "rdnss": {
+                            "2a0e:c5c1:0:10::7": {},
+                            "2a0e:c5c1:0:10::8": {},
+                        },
                     }
+                if "dhcp relay" in tags:
+                    dhcp_relay_count += 1
+                    config["service"]["dhcp-relay"]["default"]["interface"][
+                        iif["name"]
+                    ] = {}
+
+                ifaces[slugify(iif["name"])] = oif
+
+            config["interface"] = ifaces
+            if vlans:
+                vlanstr = format_vlan_ranges(vlans)
+                config["bridge"]["domain"]["br_default"]["vlan"][vlanstr] = {}
+            else:
+                del config["bridge"]["domain"]["br_default"]["vlan"]
 
-                config["vrf"]["default"]["router"]["static"] = ostatic
+            stp_priority = device["_custom_field_data"].get("spanning_tree_priority")
+            if not stp_priority:
+                stp_priority = 4
+            # no, .get alone is not enough, since nautobot can also contain a Null value here
 
-                config["system"]["aaa"]["user"] = ousers
-                device["config"] = config
-                # [{"set": config}]
+            config["bridge"]["domain"]["br_default"]["stp"]["priority"] = (
+                stp_priority * 4096
+            )
 
-            elif usecase == "switch_arista_sampelModel":
-                for iface in device["interfaces"]:
-                    tagged = [str(vlan["vid"]) for vlan in iface["tagged_vlans"]]
-                    if len(tagged) != 0:
-                        iface["tagged_vlans"] = ",".join(tagged)
-                    else:
-                        iface["tagged_vlans"] = "none"
-            elif usecase == "switch_arista_1234":
-                print("doing other stuff")
+            if dhcp_relay_count == 0:
+                config["service"].pop("dhcp-relay")
+
+            for routing in device["bgp_routing_instances"]:
+                config["router"]["bgp"]["autonomous-system"] = routing[
+                    "autonomous_system"
+                ]["asn"]
+                for endpoint in routing["endpoints"]:
+                    peer = endpoint["peer"]
+                    oneigh[peer["source_ip"]["host"]] = {
+                        "address-family": {
+                            "ipv{}-unicast".format(peer["source_ip"]["ip_version"]): {
+                                "enable": "on"
+                            }
+                        },
+                        "remote-as": peer["autonomous_system"]["asn"],
+                        "type": "numbered",
+                    }
+            config["vrf"]["default"]["router"]["bgp"]["neighbor"] = oneigh
+            if not oneigh:
+                log.warning(
+                    "routing instance has no neighbors {nodename} {serial}".format(
+                        **device
+                    )
+                )
 
-        return data
+            ostatic = dict()
+
+            for prefix in device["rel_reject_routes"]:
+                ostatic[prefix["prefix"]] = {
+                    "via": {"reject": {"type": "reject"}},
+                    "address-family": f"ipv{prefix['ip_version']}-unicast",
+                }
+
+            config["vrf"]["default"]["router"]["static"] = ostatic
+
+            config["system"]["aaa"]["user"] = self.cumulus_users
+            device["config"] = config
+            # [{"set": config}]
+
+        elif usecase == "switch_arista_sampelModel":
+            device["interfaces"] = [dict(iface) for iface in device["interfaces"]]
+            for iface in device["interfaces"]:
+                tagged = [str(vlan["vid"]) for vlan in iface["tagged_vlans"]]
+                if len(tagged) != 0:
+                    iface["tagged_vlans"] = ",".join(tagged)
+                else:
+                    iface["tagged_vlans"] = "none"
+        elif usecase == "switch_arista_1234":
+            print("doing other stuff")
+
+        return device
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import itertools
+import json
+import logging
+import multiprocessing
+import signal
+from concurrent import futures
+
+import gpncfg
+
+from ..fiddle import (
+    Fiddler,
+    get_device_fingerprint,
+    get_fingerprint,
+    get_timestamp,
+    sanitize_vlans,
+    shallow_copy,
+)
+from ..render import Conglomerate, Renderer, index_vlans, prune_vlans, replace_motd
+
+log = logging.getLogger(__name__)
+
+# fiddler and renderer of a worker process, set up once when it starts
+fiddler = None
+renderer = None
+
+
+def init_worker(cfg):
+    global fiddler, renderer
+    # ^C is handled by the main process, which shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger().addHandler(gpncfg.color_handler())
+    logging.getLogger().setLevel(cfg.log_level)
+    fiddler = Fiddler(cfg)
+    renderer = Renderer(cfg)
+
+
+def render_shard(shared, devices, ts):
+    data = fiddler.fiddle(dict(shared, devices=devices), ts)
+    return list(renderer.render(data).values())
+
+
+class JobPool:
+    """
+    Fiddles and renders the devices in --jobs worker processes. Each worker
+    gets the config once when it starts, and the vlans together with a
+    contiguous shard of the devices for every generation. The results are
+    collected in the order of the devices, so the configs are the same as
+    when fiddling and rendering them in the main process.
+
+    The shards go to whichever worker is free, so the memos of the workers
+    rarely see the same devices again. Instead the configs of the previous
+    generation are kept here, and only the devices whose data changed are
+    sent to the workers. Streamed configs are not kept, so with
+    --stream-configs all devices are sent every time.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.pool = None
+        self.fiddler = Fiddler(cfg)
+        # configs made during the previous generation by the fingerprint of
+        # their device, together with the fingerprint of the vlans they were
+        # rendered with and the json encoded motd they contain
+        self.memo = dict()
+
+    def get_vlans_fingerprint(self, cwc, vlans, index):
+        if "vlans" not in cwc.context:
+            return None
+        return get_fingerprint(prune_vlans(vlans, index, cwc.device.get("used_vids")))
+
+    def reuse(self, fingerprint, motd, vlans, index):
+        """
+        Return the config made from the same device during the previous
+        generation with the new motd, or None if the device has to be fiddled
+        and rendered again.
+        """
+        try:
+            cwc, vlans_fingerprint, old = self.memo[fingerprint]
+        except KeyError:
+            return None
+        if self.get_vlans_fingerprint(cwc, vlans, index) != vlans_fingerprint:
+            return None
+        config = cwc.text if cwc.payload is None else cwc.payload
+        if (config := replace_motd(config, old, json.dumps(motd))) is None:
+            return None
+
+        device = self.fiddler.replace_motd(cwc.device, motd)
+        reused = Conglomerate(dict(cwc.context, device=device), device)
+        if cwc.payload is None:
+            reused.set_config(config)
+        else:
+            reused.payload = config
+        return reused
+
+    def fiddle_and_render(self, data):
+        if self.pool is None:
+            # threads are already running, so do not fork
+            self.pool = futures.ProcessPoolExecutor(
+                max_workers=self.cfg.jobs,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(self.cfg,),
+            )
+
+        ts = get_timestamp()
+        shared = {key: value for key, value in data.items() if key != "devices"}
+        motd = self.fiddler.get_motd(shared, ts)
+        vlans = sanitize_vlans(shallow_copy(shared))["vlans"]
+        index = index_vlans(vlans)
+
+        configs = dict()
+        memo = dict()
+        devices = list()
+        for device in data["devices"]:
+            fingerprint = get_device_fingerprint(device)
+            if (cwc := self.reuse(fingerprint, motd, vlans, index)) is not None:
+                vlans_fingerprint = self.memo[fingerprint][1]
+                memo[fingerprint] = (cwc, vlans_fingerprint, json.dumps(motd))
+            else:
+                devices.append(device)
+            # keeps the order of the devices until the rendered ones are in
+            configs[device["id"]] = cwc
+        log.info(
+            f"fiddling and rendering {len(devices)} of {len(configs)} devices in {self.cfg.jobs} processes"
+        )
+
+        size = max(1, -(-len(devices) // self.cfg.jobs))
+        shards = [devices[i : i + size] for i in range(0, len(devices), size)]
+        for results in self.pool.map(
+            render_shard, itertools.repeat(shared), shards, itertools.repeat(ts)
+        ):
+            for cwc in results:
+                configs[cwc.device["id"]] = cwc
+                if self.cfg.stream_configs or not cwc.has_config():
+                    continue
+                memo[cwc.device["fingerprint"]] = (
+                    cwc,
+                    self.get_vlans_fingerprint(cwc, vlans, index),
+                    json.dumps(motd),
+                )
+        self.memo = memo
+        return configs
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -15,8 +15,10 @@ from .. import deployment, threadaction
 from ..config import ConfigProvider
 from ..data_provider import DataProvider
 from ..fiddle import Fiddler
+from ..jobs import JobPool
 from ..render import Renderer
 from ..statistics import Statistics
+from ..trigger import Trigger
 from ..writer import Cleaner, Writer
 
 log = logging.getLogger(__name__)
@@ -72,25 +74,31 @@ class MainAction:
         self.cfg = cfgp.options
         self.exit = threading.Event()
 
+        self.dp = DataProvider(self.cfg)
+        self.generation = None
+        self.configs = None
         self.fiddler = Fiddler(self.cfg)
         self.renderer = Renderer(self.cfg)
+        self.jobs = JobPool(self.cfg)
+        self.trigger = Trigger(self.cfg)
         self.writer = Writer(self.cfg, self.exit)
         self.cleaner = Cleaner(self.cfg, self.exit)
 
         log.info("gpncfg greets gulli gulasch")
 
-    def fetch_data(self):
+    def assert_output_writeable(self):
         os.makedirs(self.cfg.output_dir, exist_ok=True)
         assert os.access(
             self.cfg.output_dir, os.W_OK
         ), f"output directory at '{self.cfg.output_dir}' is not writeable"
 
-        dp = DataProvider(self.cfg)
+    def fetch_data(self):
+        self.assert_output_writeable()
 
         if self.cfg.use_cache:
-            dp.fetch_cache()
+            self.dp.fetch_cache()
         else:
-            dp.fetch_nautobot()
+            self.dp.fetch_nautobot()
             if self.cfg.daemon:
                 sts = Statistics()
                 sts.set_fetch()
@@ -98,16 +106,68 @@ class MainAction:
         if self.cfg.populate_cache:
             return None
 
-        data = self.fiddler.fiddle(dp.data)
+        if self.dp.generation == self.generation:
+            log.debug(
+                f"data generation {self.generation} is unchanged, skipping config generation"
+            )
+            return None
+        self.generation = self.dp.generation
+
+        data = self.get_working_set(self.dp.data)
+        if self.cfg.jobs > 1:
+            return self.jobs.fiddle_and_render(data)
+        data = self.fiddler.fiddle(data)
         return self.renderer.render(data)
 
+    def get_working_set(self, data):
+        """
+        Select the devices configs are generated for. With --limit only those
+        devices are fiddled, rendered and written, otherwise all of them.
+        """
+        if not self.cfg.limit:
+            return data
+
+        log.info(
+            f"only generating configs for the {len(self.cfg.limit)} limited devices"
+        )
+        limit = set(self.cfg.limit)
+        data = dict(data)
+        data["devices"] = (
+            device for device in data["devices"] if device["id"] in limit
+        )
+        return data
+
+    def run_device(self):
+        """
+        Fetch, fiddle and render only the device selected by --device. Its
+        config is written to the output directory and printed.
+        """
+        self.assert_output_writeable()
+        try:
+            self.dp.fetch_device(self.cfg.device)
+        finally:
+            self.dp.disconnect()
+
+        data = self.fiddler.fiddle(self.dp.data)
+        for cwc in self.renderer.render(data).values():
+            self.writer.write_config(cwc)
+            if config := cwc.read():
+                print(config)
+
     def run(self):
+        if self.cfg.device:
+            self.run_device()
+            return None
+
         if self.cfg.daemon:
             statistics = Statistics()
             statistics.start_http_server(int(self.cfg.prometheus_port))
+            self.trigger.start_http_server()
 
         if self.cfg.populate_cache:
-            return self.fetch_data()
+            self.fetch_data()
+            self.dp.disconnect()
+            return None
 
         futs_device = set()
         futs_action = set()
@@ -119,7 +179,16 @@ class MainAction:
             while True:
                 # wait for new data from nautobot
                 configs = self.fetch_data()
+                changed = configs is not None
+                if changed:
+                    self.configs = configs
+                else:
+                    # the data generation did not change. reuse the previous
+                    # configs, but only hand them to newly started workers
+                    configs = self.configs
 
+                # configs that were already written only get their timestamp
+                # refreshed, so the cleaner does not remove them
                 if q := queues.get("action-writer"):
                     q.put(configs.values())
 
@@ -164,6 +233,8 @@ class MainAction:
                 # send new configs to devices
                 for cwc in configs.values():
                     id = get_id_from_cwc(cwc)
+                    if not changed and id not in new:
+                        continue
                     try:
                         queues[id].put(cwc)
                     except KeyError:
@@ -211,8 +282,12 @@ class MainAction:
                 # to relax
                 if self.cfg.use_cache:
                     time.sleep(10)
+                else:
+                    self.trigger.wait(changed)
 
             ## this is only executed when we are not doing continuous generation/deployments
+            self.dp.disconnect()
+            self.jobs.shutdown()
             log.info(
                 "deployments are commencing. this ritual may take multiple minutes."
             )
@@ -257,6 +332,9 @@ class MainAction:
                 # wait for workers to finish and log their result
                 handle_worker_exits(futs, 360)
 
+                self.dp.disconnect()
+                self.jobs.shutdown()
+
                 log.info("all workers exited. gpncfg knows it will join them soon")
 
                 # exit with non zero code if the main loop got interrupted by an error
@@ -6,6 +6,10 @@ import os
 
 import jinja2
 
+from .. import canonical
+from ..fiddle import get_fingerprint
+from ..writer import get_config_path
+
 log = logging.getLogger(__name__)
 
 TEMPLATE_MAP = {
@@ -21,6 +25,47 @@ TEMPLATE_MAP = {
     "core-switch_mellanox_sn3420": "json",
 }
 
+# directory inside the cache directory holding compiled templates
+BYTECODE_CACHE = "jinja2"
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    A bytecode cache that never keeps templates from compiling. Templates it
+    cannot load or store are just compiled again.
+    """
+
+    def load_bytecode(self, bucket):
+        try:
+            super().load_bytecode(bucket)
+        except OSError as e:
+            log.debug(f"failed to load compiled template {bucket.key}", exc_info=e)
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError as e:
+            log.debug(f"failed to store compiled template {bucket.key}", exc_info=e)
+
+
+def get_bytecode_cache(cfg):
+    """
+    Compiled templates are kept in the cache directory, so short runs do not
+    have to compile them again. jinja2 recompiles a template when its source
+    changed. In offline mode the cache directory may not be writeable, then
+    templates are compiled every time.
+    """
+    path = os.path.join(cfg.cache_dir, BYTECODE_CACHE)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError as e:
+        log.warning(f"cannot cache compiled templates at '{path}'", exc_info=e)
+        return None
+    if not os.access(path, os.W_OK):
+        log.info(f"not caching compiled templates, '{path}' is not writeable")
+        return None
+    return BytecodeCache(path)
+
 
 def get_template_path():
     cur_dir = os.path.dirname(__file__)
@@ -28,24 +73,90 @@ def get_template_path():
     return epath
 
 
+def index_vlans(vlans):
+    """
+    Map each vid to the positions of the vlans with that vid.
+    """
+    index = dict()
+    for pos, vlan in enumerate(vlans):
+        index.setdefault(vlan["vid"], []).append(pos)
+    return index
+
+
+def prune_vlans(vlans, index, vids):
+    """
+    Return the vlans with the given vids in their original order, or all of
+    them if vids is None.
+    """
+    if vids is None:
+        return vlans
+    positions = sorted(pos for vid in vids for pos in index.get(vid, ()))
+    return [vlans[pos] for pos in positions]
+
+
+def wrap_payload(payload):
+    """
+    Return the config file for a json payload, which applies it as a set
+    operation. json strings do not contain newlines, so indenting the lines
+    of the payload results in the same text as serializing the whole file.
+    """
+    return '[\n  {\n    "set": ' + payload.replace("\n", "\n    ") + "\n  }\n]"
+
+
+def replace_motd(config, old, motd):
+    """
+    Return the config with the json encoded motd old replaced by motd, or None
+    if it does not occur exactly once.
+    """
+    if config.count(old) != 1:
+        return None
+    return config.replace(old, motd)
+
+
 class Conglomerate:
-    config: str | None
     context: dict
     device: dict
     path: str
+    payload: str | None
+    text: str | None
 
-    def __init__(self, cfg, data, device):
-        self.cfg = cfg
+    def __init__(self, context, device):
         self.device = device
-        self.context = dict()
-        self.context["config"] = self.cfg.__dict__
-        self.context["vlans"] = data["vlans"]
-        self.context["device"] = device
-        self.config = None
-        self.data = data
+        self.context = context
+        self.path = None
+        self.payload = None
+        self.text = None
+
+    @property
+    def config(self):
+        """
+        Json configs are only kept as the payload uploaded to the device, the
+        config file is made from it when it is needed. Use has_config to find
+        out whether there is a config.
+        """
+        if self.payload is not None:
+            return wrap_payload(self.payload)
+        return self.text
 
     def set_config(self, config):
-        self.config = config
+        self.text = config
+
+    def has_config(self):
+        """
+        Return whether a config was rendered, either kept in memory or
+        streamed into its file.
+        """
+        return bool(self.payload or self.text or self.path)
+
+    def read(self):
+        """
+        Return the config, reading it from its file if it was streamed there.
+        """
+        if self.payload is None and self.text is None and self.path:
+            with open(self.path) as file:
+                # the file ends with a newline that is not part of the config
+                return file.read()[:-1]
+        return self.config
 
 
 class Renderer:
@@ -56,12 +167,81 @@ class Renderer:
             loader=jinja2.FileSystemLoader(searchpath=[get_template_path()]),
             trim_blocks=True,
             lstrip_blocks=True,
+            # fail on data missing from the context instead of silently
+            # rendering nothing in its place
+            undefined=jinja2.StrictUndefined,
+            bytecode_cache=get_bytecode_cache(cfg),
+        )
+        # compile all templates right away, so broken ones are noticed before
+        # any config is rendered
+        self.templates = dict()
+        for name in set(TEMPLATE_MAP.values()) - {"json"}:
+            self.templates[name] = self.j2.get_template(name)
+        # the settings the templates read. the contexts only carry these, so
+        # secrets are not passed around with every device
+        self.config = {
+            "login": {"root": {"md5": self.cfg.login.root.md5}},
+            "snmp_community": self.cfg.snmp_community,
+            "syslog_server": self.cfg.syslog_server,
+        }
+        # configs rendered during the previous run together with the motd
+        # they contain, keyed by template and the fingerprints of the data
+        # they were rendered from. the templates do not change while gpncfg
+        # runs.
+        self.memo = dict()
+        # parts of the configs that are the same for every device are only
+        # rendered once and shared by all templates
+        self.j2.globals["junos_users"] = self.j2.get_template("junos-users.j2").render(
+            config=self.cfg.__dict__
         )
 
+    def reuse(self, key, motd):
+        """
+        Return the config rendered from the same data during the previous
+        run, with the new motd. Both jinja configs and json payloads contain
+        the motd json encoded. If it cannot be replaced unambiguously, None is
+        returned and the config has to be rendered again.
+        """
+        try:
+            config, old = self.memo[key]
+        except KeyError:
+            return None
+        return replace_motd(config, old, motd)
+
+    def stream_config(self, cwc, chunks):
+        """
+        Write the config chunk by chunk into its file in the output directory
+        instead of keeping it in memory. The file is replaced at once, so a
+        deploy worker still uploading the previous config is not affected.
+        """
+        path = get_config_path(self.cfg, cwc.device)
+        with open(path + ".new", "w") as file:
+            for chunk in chunks:
+                file.write(chunk)
+            # end the file like the writer does
+            file.write("\n")
+        os.replace(path + ".new", path)
+        cwc.path = path
+
+    def get_context(self, template_name, data, index, device):
+        context = {"device": device}
+        # json configs are made from the device alone
+        if template_name and template_name != "json":
+            context["config"] = self.config
+            # only define the vlans the device uses
+            context["vlans"] = prune_vlans(
+                data["vlans"], index, device.get("used_vids")
+            )
+        return context
+
     def render(self, data):
         log.info("rendering configs")
 
         configs = dict()
+        memo = dict()
+        reused = 0
+        motd = json.dumps(data["motd"])
+        index = index_vlans(data["vlans"])
 
         missing_usecases = set()
 
@@ -73,9 +253,9 @@ class Renderer:
                     serial=device["serial"],
                 )
             )
-            cwc = Conglomerate(self.cfg, data, device)
-
             template_name = TEMPLATE_MAP.get(usecase)
+            context = self.get_context(template_name, data, index, device)
+            cwc = Conglomerate(context, device)
             if not template_name:
                 log.warning(
                     "failed to find template for usecase {} when rendering {nodename} {serial}".format(
@@ -84,19 +264,32 @@ class Renderer:
                 )
                 missing_usecases.add(usecase)
             elif template_name == "json":
-                cwc.set_config(
-                    json.dumps([{"set": device["config"]}], indent=2, sort_keys=True)
-                )
+                # the payload is uploaded to the device as it is, the file
+                # applies it as a set operation
+                key = (template_name, device["fingerprint"])
+                if (payload := self.reuse(key, motd)) is not None:
+                    reused += 1
+                else:
+                    payload = canonical.dumps(device["config"], indent=True)
+                memo[key] = (payload, motd)
+                cwc.payload = payload
+                if self.cfg.stream_configs:
+                    self.stream_config(cwc, [cwc.config])
+            elif self.cfg.stream_configs:
+                # streamed configs are not kept, so they cannot be reused
+                template = self.templates[template_name]
+                self.stream_config(cwc, template.generate(context))
             else:
-                try:
-                    template = self.j2.get_template(template_name)
-                    cwc.set_config(template.render(cwc.context))
-                except jinja2.TemplateNotFound:
-                    raise Exception(
-                        "failed to find jinja2 template {} for usecase {} for device {serial} {nodename}".format(
-                            template_name, usecase, **device
-                        )
-                    )
+                key = (template_name, device["fingerprint"])
+                if "vlans" in context:
+                    key += (get_fingerprint(context["vlans"]),)
+                if (config := self.reuse(key, motd)) is not None:
+                    cwc.set_config(config)
+                    reused += 1
+                else:
+                    template = self.templates[template_name]
+                    cwc.set_config(template.render(context))
+                memo[key] = (cwc.text, motd)
 
             configs[device["id"]] = cwc
 
@@ -105,4 +298,7 @@ class Renderer:
                 f"failed to load templates for these usecases: {missing_usecases}"
             )
 
+        log.debug(f"rendered {len(configs)} configs, reused {reused} of them")
+        self.memo = memo
+
         return configs
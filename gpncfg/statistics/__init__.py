@@ -20,6 +20,7 @@ class Statistics(object):
     _instance = None
     _data: Dict[StatisticsType, Gauge] = {}
     _fetch: Gauge = None
+    _webhook: Gauge = None
     _server = None
     _server_thread: Optional[Thread] = None
 
@@ -35,6 +36,9 @@ class Statistics(object):
             cls._instance._fetch = Gauge(
                 "gpncfg_fetch", "Last time data was fetched from nautobot"
             )
+            cls._instance._webhook = Gauge(
+                "gpncfg_webhook", "Last time a webhook from nautobot was received"
+            )
         return cls._instance
 
     def start_http_server(self, port: int) -> None:
@@ -56,3 +60,6 @@ class Statistics(object):
 
     def set_fetch(self) -> None:
         self._fetch.set_to_current_time()
+
+    def set_webhook(self) -> None:
+        self._webhook.set_to_current_time()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import hashlib
+import hmac
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ..statistics import Statistics
+
+log = logging.getLogger(__name__)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        trigger = self.server.trigger
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_response(400)
+            self.end_headers()
+            return
+        body = self.rfile.read(length)
+
+        if self.path.rstrip("/") != "/webhook":
+            self.send_response(404)
+        elif not trigger.verify(body, self.headers.get("X-Hook-Signature")):
+            log.warning(f"rejecting webhook from {self.client_address[0]}")
+            self.send_response(403)
+        else:
+            trigger.notify()
+            self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class Trigger:
+    """
+    Decides when the main loop fetches data from nautobot again. A webhook
+    from nautobot triggers a fetch once no further webhooks arrived for
+    --webhook-debounce seconds. Without webhooks nautobot is polled, and the
+    polling interval doubles up to --poll-interval-max as long as the fetched
+    data does not change.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.event = threading.Event()
+        self.first_notify = None
+        self.last_notify = None
+        self.interval = cfg.poll_interval_min
+        self.server = None
+
+    def start_http_server(self):
+        if not self.cfg.webhook_port:
+            return
+        self.server = ThreadingHTTPServer(("", self.cfg.webhook_port), WebhookHandler)
+        self.server.trigger = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info(f"listening for nautobot webhooks on port {self.cfg.webhook_port}")
+
+    def verify(self, body, signature):
+        if not signature:
+            return False
+        # nautobot signs the body with the secret configured for the webhook
+        expected = hmac.new(
+            self.cfg.webhook_secret.encode(), body, hashlib.sha512
+        ).hexdigest()
+        return hmac.compare_digest(expected, signature)
+
+    def notify(self):
+        now = time.monotonic()
+        if not self.event.is_set():
+            self.first_notify = now
+        self.last_notify = now
+        self.event.set()
+        Statistics().set_webhook()
+        log.debug("received webhook from nautobot")
+
+    def wait(self, changed):
+        if changed:
+            self.interval = self.cfg.poll_interval_min
+        else:
+            self.interval = min(self.interval * 2, self.cfg.poll_interval_max)
+
+        log.debug(f"polling nautobot again in {self.interval} seconds")
+        deadline = time.monotonic() + self.interval
+        # wait in short steps so ^C is handled promptly
+        while (rest := deadline - time.monotonic()) > 0:
+            if self.event.wait(min(rest, 1)):
+                break
+        else:
+            return
+
+        # wait for the webhooks of a bulk change to settle, but fetch the data
+        # eventually even if nautobot keeps sending them
+        while True:
+            now = time.monotonic()
+            until = min(
+                self.last_notify + self.cfg.webhook_debounce,
+                self.first_notify + self.cfg.poll_interval_max,
+            )
+            if until <= now:
+                break
+            time.sleep(min(until - now, 1))
+        self.event.clear()
+        log.info("fetching data from nautobot after receiving a webhook")
@@ -8,6 +8,12 @@ from ..threadaction import Action
 log = logging.getLogger(__name__)
 
 
+def get_config_path(cfg, device):
+    return os.path.abspath(
+        os.path.join(cfg.output_dir, "config-{serial}".format(**device))
+    )
+
+
 class Writer(Action):
     def __init__(self, *args):
         self.name = "action-writer"
@@ -35,7 +41,7 @@ class Writer(Action):
     def write_config(self, cwc):
         device = cwc.device
         serial = device["serial"]
-        if not cwc.config:
+        if not cwc.has_config():
             self.log.debug(
                 "not writing config for serial {serial} because it is empty".format(
                     **device
@@ -43,11 +49,18 @@ class Writer(Action):
             )
             return
 
-        self.log.debug("writing config for serial {serial}".format(**device))
-        name_serial = "config-{serial}".format(**device)
-        cwc.path = os.path.abspath(os.path.join(self.cfg.output_dir, name_serial))
-        with open(cwc.path, "w+") as file:
-            print(cwc.config, file=file)
+        path = get_config_path(self.cfg, device)
+        if cwc.path and os.path.exists(cwc.path):
+            # written during an earlier loop, the data did not change since
+            self.log.debug(
+                "refreshing config timestamp for serial {serial}".format(**device)
+            )
+            os.utime(cwc.path)
+        else:
+            self.log.debug("writing config for serial {serial}".format(**device))
+            with open(path, "w+") as file:
+                print(cwc.config, file=file)
+            cwc.path = path
 
         by_name = os.path.abspath(
             os.path.join(self.cfg.output_dir, "config-{nodename}".format(**device))
@@ -58,7 +71,7 @@ class Writer(Action):
             except FileNotFoundError:
                 pass
         try:
-            os.symlink(name_serial, by_name)
+            os.symlink(os.path.basename(path), by_name)
         except FileExistsError:
             pass
 